@@ -3,9 +3,10 @@ import pandas as pd
 import plotly.express as px
 from datetime import datetime
 import io
-import time
 import requests
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Set Streamlit page configuration
 st.set_page_config(
@@ -140,6 +141,8 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+ANALYSIS_PLACEHOLDER = '<p style="color:#000000;">Click a button above to generate the analysis.</p>'
+
 # Initialize session state variables
 if 'all_data' not in st.session_state:
     st.session_state.all_data = pd.DataFrame()
@@ -148,7 +151,140 @@ if 'filtered_data' not in st.session_state:
 if 'data_cleaned_success' not in st.session_state:
     st.session_state.data_cleaned_success = False
 if 'analysis_output' not in st.session_state:
-    st.session_state.analysis_output = '<p style="color:#000000;">Click a button above to generate the analysis.</p>'
+    st.session_state.analysis_output = ANALYSIS_PLACEHOLDER
+if 'jobs' not in st.session_state:
+    st.session_state.jobs = {} # Current background jobs, keyed by kind ('clean', 'analysis')
+if 'inflight_jobs' not in st.session_state:
+    st.session_state.inflight_jobs = {} # Per kind, every job still occupying a worker, including superseded ones
+if 'upload_id' not in st.session_state:
+    st.session_state.upload_id = None
+if 'pending_upload' not in st.session_state:
+    st.session_state.pending_upload = None # Bytes of an upload waiting for a free cleaning slot
+if 'clean_status' not in st.session_state:
+    st.session_state.clean_status = None # 'waiting', or the outcome of the last cleaning: 'success', 'empty', 'error' or 'cancelled'
+if 'clean_error' not in st.session_state:
+    st.session_state.clean_error = None
+
+
+# --- Background Jobs ---
+# Heavy work (cleaning, AI aggregation and calls) runs on shared, bounded thread pools so the
+# script thread stays free. Worker threads must not touch st.* or st.session_state; they only
+# return results, which the script thread picks up on the next run.
+MAX_BACKGROUND_WORKERS = 4
+MAX_NETWORK_WORKERS = 8
+MAX_JOBS_PER_KIND = 3 # Per session; counts superseded jobs until their worker is actually released
+JOB_POLL_INTERVAL = 0.5 # Seconds between progress refreshes in the UI
+OPENROUTER_TIMEOUT = 120 # Seconds before an OpenRouter request is abandoned
+
+@st.cache_resource
+def get_worker_pool():
+    """Returns the pool for CPU-bound work (cleaning, aggregation), shared by all sessions."""
+    return ThreadPoolExecutor(max_workers=MAX_BACKGROUND_WORKERS, thread_name_prefix="zentra-worker")
+
+@st.cache_resource
+def get_network_pool():
+    """
+    Returns the pool for AI API calls, shared by all sessions.
+    An HTTP request cannot be interrupted, so a cancelled call keeps its thread until it returns;
+    keeping these separate stops abandoned calls from starving data cleaning.
+    """
+    return ThreadPoolExecutor(max_workers=MAX_NETWORK_WORKERS, thread_name_prefix="zentra-network")
+
+class JobCancelled(Exception):
+    """Raised inside a job once it has been cancelled or superseded."""
+
+class UnexpectedAIResponse(Exception):
+    """Raised when the AI provider returns a payload without a message."""
+    def __init__(self, result):
+        super().__init__("AI response format unexpected.")
+        self.result = result
+
+class BackgroundJob:
+    """
+    Handle for a function running on the worker pool.
+    - The function is called as fn(job, *args) and can report progress through the job.
+    - Cancellation is cooperative: report(), check_cancelled() and sleep() raise JobCancelled.
+    """
+    def __init__(self, pool, fn, *args):
+        self._cancel_event = threading.Event()
+        self.progress = 0.0
+        self.message = "Queued..."
+        self.future = pool.submit(self._run, fn, *args)
+
+    def _run(self, fn, *args):
+        self.check_cancelled()
+        return fn(self, *args)
+
+    def report(self, progress, message):
+        self.check_cancelled()
+        self.progress = min(max(progress, 0.0), 1.0)
+        self.message = message
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def sleep(self, seconds):
+        if self._cancel_event.wait(seconds):
+            raise JobCancelled()
+
+    def cancel(self):
+        self._cancel_event.set()
+        self.future.cancel() # Only succeeds if the job has not started yet
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()
+
+def submit_job(kind, pool, fn, *args):
+    """
+    Starts a job of the given kind on the given pool, cancelling the one it supersedes.
+    Returns False if this session already has too many jobs of that kind occupying workers;
+    the cap is per kind so stuck AI calls never hold back data cleaning.
+    """
+    cancel_job(kind)
+    inflight = [job for job in st.session_state.inflight_jobs.get(kind, []) if not job.done()]
+    if len(inflight) >= MAX_JOBS_PER_KIND:
+        st.session_state.inflight_jobs[kind] = inflight
+        return False
+    job = BackgroundJob(pool, fn, *args)
+    st.session_state.jobs[kind] = job
+    st.session_state.inflight_jobs[kind] = inflight + [job]
+    return True
+
+def cancel_job(kind):
+    job = st.session_state.jobs.pop(kind, None)
+    if job is not None:
+        job.cancel()
+
+def pop_finished_job(kind):
+    """Returns the job of the given kind if it has finished, removing it from the session."""
+    job = st.session_state.jobs.get(kind)
+    if job is None or not job.done():
+        return None
+    del st.session_state.jobs[kind]
+    return None if job.cancelled else job
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_job_progress(kind, label, on_cancel=None):
+    """Polls a running job; only this fragment reruns, so the rest of the dashboard stays usable."""
+    job = st.session_state.jobs.get(kind)
+    if job is None:
+        return
+    if job.done():
+        st.rerun() # Rerun the whole app so the result is picked up
+    st.progress(job.progress, text=f"{label} {job.message}")
+    if st.button("Cancel", key=f"cancel_{kind}_job", type="secondary"):
+        cancel_job(kind)
+        if on_cancel is not None:
+            on_cancel()
+        st.rerun()
 
 
 st.title("Interactive Media Intelligence Dashboard")
@@ -158,15 +294,19 @@ st.header("1. Upload CSV File")
 st.markdown("Please upload a CSV file with the following columns: `Date`, `Platform`, `Sentiment`, `Location`, `Engagements`, `Media Type`, `Influencer Brand`, `Post Type`.")
 uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
 
-@st.cache_data(show_spinner=False)
-def clean_data(df):
+def clean_data(df, job=None):
     """
     Cleans the raw data from CSV parsing.
     - Converts 'Date' to datetime objects.
     - Fills missing 'Engagements' with 0.
     - Normalizes column names (handles minor variations).
     - Ensures essential columns are handled for missing/empty values.
+    job receives progress updates when run as a background job.
     """
+    def report(progress, message):
+        if job is not None:
+            job.report(progress, message)
+
     if df.empty:
         return pd.DataFrame()
 
@@ -181,7 +321,8 @@ def clean_data(df):
 
     # Ensure required columns exist, fill with 'Unknown' if missing
     required_cols = ['Date', 'Platform', 'Sentiment', 'Location', 'Engagements', 'Media Type', 'Influencer Brand', 'Post Type']
-    for col in required_cols:
+    for i, col in enumerate(required_cols):
+        report(0.2 + 0.5 * i / len(required_cols), f"Cleaning column '{col}'...")
         if col not in df.columns:
             df[col] = 'Unknown'
         else:
@@ -192,36 +333,94 @@ def clean_data(df):
             df.loc[df[col] == '', col] = 'Unknown' # Replace actual empty strings with 'Unknown'
 
     # Convert 'Date' to datetime, coercing errors to NaT
+    report(0.75, "Parsing dates...")
     df['Date'] = pd.to_datetime(df['Date'], errors='coerce')
 
     # Drop rows where 'Date' could not be parsed
     df.dropna(subset=['Date'], inplace=True)
 
     # Convert 'Engagements' to numeric, filling NaNs with 0
+    report(0.9, "Converting engagements...")
     df['Engagements'] = pd.to_numeric(df['Engagements'], errors='coerce').fillna(0)
 
     return df
 
-if uploaded_file is not None:
-    with st.spinner("Processing data..."):
-        try:
-            raw_data = pd.read_csv(uploaded_file)
-            st.session_state.all_data = clean_data(raw_data.copy())
-            st.session_state.filtered_data = st.session_state.all_data.copy()
-            st.session_state.data_cleaned_success = True
-
-            if st.session_state.all_data.empty:
-                st.error("No valid data found in the CSV after cleaning. Please check the file format and content.")
-                st.session_state.data_cleaned_success = False
-            else:
-                st.success("Data Cleaned Successfully!")
-                st.session_state.data_cleaned_success = True
+def load_and_clean_job(job, file_bytes):
+    job.report(0.05, "Reading CSV...")
+    raw_data = pd.read_csv(io.BytesIO(file_bytes))
+    return clean_data(raw_data.copy(), job=job)
+
+def cancel_cleaning():
+    # Keep upload_id so the same file is not re-cleaned straight away; the user can restart it
+    st.session_state.clean_status = 'cancelled'
+
+def start_pending_upload():
+    """Submits the waiting upload for cleaning; returns True once it has been started."""
+    if st.session_state.pending_upload is None:
+        return False
+    if not submit_job('clean', get_worker_pool(), load_and_clean_job, st.session_state.pending_upload):
+        return False
+    st.session_state.pending_upload = None
+    st.session_state.clean_status = None
+    return True
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def retry_pending_upload():
+    """Keeps trying to start a waiting upload until a cleaning slot frees up."""
+    if start_pending_upload():
+        st.rerun() # Rerun the whole app so the progress bar replaces the waiting notice
 
-        except Exception as e:
-            st.error(f"Error reading or cleaning file: {e}")
-            st.session_state.data_cleaned_success = False
-            st.session_state.all_data = pd.DataFrame() # Reset dataframes on error
-            st.session_state.filtered_data = pd.DataFrame()
+if uploaded_file is not None:
+    # Only start cleaning when a different file arrives; a newer upload supersedes older work
+    upload_id = getattr(uploaded_file, 'file_id', None) or (uploaded_file.name, uploaded_file.size)
+    if st.session_state.upload_id != upload_id:
+        st.session_state.upload_id = upload_id
+        st.session_state.pending_upload = uploaded_file.getvalue()
+        st.session_state.clean_status = 'waiting'
+        cancel_job('clean')
+        cancel_job('analysis')
+        start_pending_upload()
+else:
+    st.session_state.upload_id = None
+    st.session_state.pending_upload = None
+    cancel_job('clean')
+
+clean_job = pop_finished_job('clean')
+if clean_job is not None:
+    # Anything started on the previous dataset is stale once the new one is swapped in
+    cancel_job('analysis')
+    st.session_state.analysis_output = ANALYSIS_PLACEHOLDER
+    try:
+        st.session_state.all_data = clean_job.result()
+        st.session_state.filtered_data = st.session_state.all_data.copy()
+        st.session_state.data_cleaned_success = not st.session_state.all_data.empty
+        st.session_state.clean_status = 'success' if st.session_state.data_cleaned_success else 'empty'
+
+    except Exception as e:
+        st.session_state.clean_status = 'error'
+        st.session_state.clean_error = e
+        st.session_state.data_cleaned_success = False
+        st.session_state.all_data = pd.DataFrame() # Reset dataframes on error
+        st.session_state.filtered_data = pd.DataFrame()
+
+cleaning_in_progress = 'clean' in st.session_state.jobs or st.session_state.pending_upload is not None
+if 'clean' in st.session_state.jobs:
+    show_job_progress('clean', "Processing data...", on_cancel=cancel_cleaning)
+elif st.session_state.upload_id is not None:
+    if st.session_state.clean_status == 'waiting':
+        st.info("Waiting for earlier jobs to finish before cleaning this file...")
+        retry_pending_upload()
+    elif st.session_state.clean_status == 'success':
+        st.success("Data Cleaned Successfully!")
+    elif st.session_state.clean_status == 'empty':
+        st.error("No valid data found in the CSV after cleaning. Please check the file format and content.")
+    elif st.session_state.clean_status == 'error':
+        st.error(f"Error reading or cleaning file: {st.session_state.clean_error}")
+    elif st.session_state.clean_status == 'cancelled':
+        st.info("Cleaning was cancelled.")
+        if st.button("Clean Data Again", type="secondary"):
+            st.session_state.upload_id = None # Forces the uploaded file to be cleaned on the rerun
+            st.rerun()
 
 # Only show dashboard content if data is available
 if not st.session_state.all_data.empty:
@@ -273,7 +472,8 @@ if not st.session_state.all_data.empty:
     filter_max_engagements = st.sidebar.number_input("Max Engagements:", min_value=0, value=max_engagements_data)
 
     # Apply Filters button
-    if st.sidebar.button("Apply Filters"):
+    if st.sidebar.button("Apply Filters", disabled=cleaning_in_progress):
+        cancel_job('analysis') # An analysis of the previous selection is now stale
         st.session_state.filtered_data = st.session_state.all_data.copy()
 
         active_filters_display = []
@@ -309,7 +509,8 @@ if not st.session_state.all_data.empty:
             st.session_state.filtered_data = pd.DataFrame() # Ensure filtered_data is empty if no match
 
     # Reset Filters button
-    if st.sidebar.button("Reset Filters", type="secondary"):
+    if st.sidebar.button("Reset Filters", type="secondary", disabled=cleaning_in_progress):
+        cancel_job('analysis')
         st.session_state.filtered_data = st.session_state.all_data.copy()
         st.sidebar.success("Filters reset!")
         st.info("No filters applied.")
@@ -467,9 +668,9 @@ if not st.session_state.all_data.empty:
 
     analysis_col1, analysis_col2 = st.columns([0.3, 0.7])
     with analysis_col1:
-        generate_our_analysis_btn = st.button("Generate Analysis (Our AI)")
+        generate_our_analysis_btn = st.button("Generate Analysis (Our AI)", disabled=cleaning_in_progress)
     with analysis_col2:
-        generate_openrouter_analysis_btn = st.button("Generate Analysis (OpenRouter AI)")
+        generate_openrouter_analysis_btn = st.button("Generate Analysis (OpenRouter AI)", disabled=cleaning_in_progress)
         openrouter_api_key = st.text_input("OpenRouter API Key (Optional):", type="password", help="Enter your OpenRouter API key (e.g., sk-...)")
         openrouter_model = st.selectbox("AI Model:",
                                         options=["openai/gpt-3.5-turbo", "mistralai/mixtral-8x7b-instruct", "google/gemini-pro", "anthropic/claude-3-opus"],
@@ -545,34 +746,72 @@ if not st.session_state.all_data.empty:
 
         return "\n".join(summary_parts)
 
+    def our_analysis_job(job, data_df):
+        job.report(0.2, "Aggregating insights...")
+        data_summary_for_ai = aggregate_insights_for_ai(data_df)
+        job.report(0.5, "Writing summary...")
+        job.sleep(1) # Simulate AI processing time
+
+        analysis_markdown = """
+        ### Executive Summary
+
+        This analysis provides key insights from your media intelligence data. It covers sentiment, engagement trends, platform performance, media type distribution, and top locations.
+
+        #### Key Findings:
+        """
+        analysis_markdown += data_summary_for_ai
+
+        analysis_markdown += """
+
+        #### Campaign Recommendations:
+        -   **Focus on High-Engagement Platforms:** Allocate more resources to platforms that show higher engagement rates to maximize reach and impact.
+        -   **Leverage Dominant Media Types:** Prioritize content creation around media types that consistently perform well and resonate with your audience.
+        -   **Address Sentiment Gaps:** If negative or neutral sentiment is significant, develop strategies to improve perception, such as addressing customer feedback or refining messaging.
+        -   **Optimize for Peak Engagement Times:** Schedule content publication to align with identified peak engagement periods to ensure maximum visibility.
+        -   **Target Key Geographic Areas:** Tailor campaigns to focus on locations demonstrating high engagement, or develop localized strategies for emerging markets.
+        -   **Diversify Content if Needed:** If insights show a lack of diversity in platforms or media types, consider experimenting with new channels or formats to expand audience reach.
+        """
+        return analysis_markdown
+
+    def openrouter_analysis_job(job, data_df, api_key, model):
+        job.report(0.1, "Aggregating insights...")
+        data_summary_for_ai = aggregate_insights_for_ai(data_df)
+        prompt = f"""
+        Based on the following media intelligence data insights, provide a concise executive summary and actionable campaign recommendations to optimize future strategies. Structure the response with clear headings for 'Executive Summary' and 'Campaign Recommendations'. Use **markdown bold** for emphasis.
+
+        {data_summary_for_ai}
+
+        Provide the output in markdown format.
+        """
+
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        payload = {
+            "model": model,
+            "messages": [
+                {"role": "user", "content": prompt}
+            ]
+        }
+
+        job.report(0.3, f"Waiting for {model}...")
+        response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload, timeout=OPENROUTER_TIMEOUT)
+        job.check_cancelled() # The request itself cannot be interrupted; drop the response if superseded
+        response.raise_for_status() # Raise an exception for HTTP errors
+        result = response.json()
+
+        if result.get("choices") and result["choices"][0].get("message"):
+            return result["choices"][0]["message"]["content"]
+        raise UnexpectedAIResponse(result)
+
     def generate_our_analysis():
         if st.session_state.filtered_data.empty:
             st.error("Please upload and analyze data first to generate an analysis.")
             return
 
-        with st.spinner("Generating analysis (Our AI)..."):
-            time.sleep(1) # Simulate AI processing time
-
-            analysis_markdown = """
-            ### Executive Summary
-
-            This analysis provides key insights from your media intelligence data. It covers sentiment, engagement trends, platform performance, media type distribution, and top locations.
-
-            #### Key Findings:
-            """
-            analysis_markdown += aggregate_insights_for_ai(st.session_state.filtered_data)
-
-            analysis_markdown += """
-
-            #### Campaign Recommendations:
-            -   **Focus on High-Engagement Platforms:** Allocate more resources to platforms that show higher engagement rates to maximize reach and impact.
-            -   **Leverage Dominant Media Types:** Prioritize content creation around media types that consistently perform well and resonate with your audience.
-            -   **Address Sentiment Gaps:** If negative or neutral sentiment is significant, develop strategies to improve perception, such as addressing customer feedback or refining messaging.
-            -   **Optimize for Peak Engagement Times:** Schedule content publication to align with identified peak engagement periods to ensure maximum visibility.
-            -   **Target Key Geographic Areas:** Tailor campaigns to focus on locations demonstrating high engagement, or develop localized strategies for emerging markets.
-            -   **Diversify Content if Needed:** If insights show a lack of diversity in platforms or media types, consider experimenting with new channels or formats to expand audience reach.
-            """
-            st.session_state.analysis_output = analysis_markdown
+        if not submit_job('analysis', get_worker_pool(), our_analysis_job, st.session_state.filtered_data):
+            st.warning("Too many analyses are still finishing. Please try again in a moment.")
 
     def generate_openrouter_analysis():
         if st.session_state.filtered_data.empty:
@@ -583,51 +822,31 @@ if not st.session_state.all_data.empty:
             st.warning("Please enter your OpenRouter API Key to use this feature.")
             return
 
-        with st.spinner(f"Generating analysis with {openrouter_model} (OpenRouter AI)..."):
-            data_summary_for_ai = aggregate_insights_for_ai(st.session_state.filtered_data)
-            prompt = f"""
-            Based on the following media intelligence data insights, provide a concise executive summary and actionable campaign recommendations to optimize future strategies. Structure the response with clear headings for 'Executive Summary' and 'Campaign Recommendations'. Use **markdown bold** for emphasis.
-
-            {data_summary_for_ai}
-
-            Provide the output in markdown format.
-            """
-
-            headers = {
-                "Authorization": f"Bearer {openrouter_api_key}",
-                "Content-Type": "application/json"
-            }
-            payload = {
-                "model": openrouter_model,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ]
-            }
-
-            try:
-                response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=payload)
-                response.raise_for_status() # Raise an exception for HTTP errors
-                result = response.json()
-
-                if result.get("choices") and result["choices"][0].get("message"):
-                    st.session_state.analysis_output = result["choices"][0]["message"]["content"]
-                else:
-                    st.error("AI response format unexpected from OpenRouter.")
-                    st.session_state.analysis_output = "AI response format unexpected."
-                    st.json(result) # Display full response for debugging
-
-            except requests.exceptions.RequestException as e:
-                st.error(f"An error occurred while calling OpenRouter AI: {e}")
-                st.session_state.analysis_output = f"Failed to get response from AI. Error: {e}"
-            except Exception as e:
-                st.error(f"An unexpected error occurred: {e}")
-                st.session_state.analysis_output = f"An unexpected error occurred: {e}"
+        if not submit_job('analysis', get_network_pool(), openrouter_analysis_job, st.session_state.filtered_data, openrouter_api_key, openrouter_model):
+            st.warning("Too many analyses are still finishing. Please try again in a moment.")
 
     if generate_our_analysis_btn:
         generate_our_analysis()
     if generate_openrouter_analysis_btn:
         generate_openrouter_analysis()
 
+    analysis_job = pop_finished_job('analysis')
+    if analysis_job is not None:
+        try:
+            st.session_state.analysis_output = analysis_job.result()
+        except UnexpectedAIResponse as e:
+            st.error("AI response format unexpected from OpenRouter.")
+            st.session_state.analysis_output = "AI response format unexpected."
+            st.json(e.result) # Display full response for debugging
+        except requests.exceptions.RequestException as e:
+            st.error(f"An error occurred while calling OpenRouter AI: {e}")
+            st.session_state.analysis_output = f"Failed to get response from AI. Error: {e}"
+        except Exception as e:
+            st.error(f"An unexpected error occurred: {e}")
+            st.session_state.analysis_output = f"An unexpected error occurred: {e}"
+    elif 'analysis' in st.session_state.jobs:
+        show_job_progress('analysis', "Generating analysis...")
+
     if 'analysis_output' in st.session_state:
         st.markdown("### Analysis Output")
         st.markdown(st.session_state.analysis_output)